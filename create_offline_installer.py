@@ -2,18 +2,28 @@
 This works by installing a temporary miniconda, downloading the required packages and all dependencies,
 then copying the newly downloaded packages, which are those not already provided by the miniconda install.
 """
+import argparse
+import concurrent.futures
 import glob
+import io
+import json
 import os
 import platform
 import requests
 import shutil
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import tempfile
 import re
 import pathlib
 
+from offline_channel_server import make_server, serve
+from package_slimming import DEFAULT_SLIM_PATTERNS, can_slim, slim_package
+from resource_monitor import ResourceMonitor
+
 # Pass the required miniconda installer version from devops pipelines variables
 def miniconda_installer_version():
     return os.environ.get('MINICONDA_INSTALLER_VERSION', 'py37_4.9.2')
@@ -216,7 +226,8 @@ if IS_WINDOWS:
                     SMTO_ABORTIFHUNG, 5000, ctypes.pointer(wintypes.DWORD()))
 
 class MinicondaOfflineInstaller:
-    def __init__(self, prefix=None, extra_conda_packages=None):
+    def __init__(self, prefix=None, extra_conda_packages=None, fold_ccdc_packages=False, resource_sample_interval=1.0,
+                 precompile_bytecode=True, slim_packages=None, slim_patterns=None):
         '''
         If prefix is not None, something other than the full installer (which
         is used in the CSDS installer to run Mercury scripts) will be built.
@@ -228,9 +239,31 @@ class MinicondaOfflineInstaller:
         Use the extra_conda_packages to specify a list of any additional conda
         packages to add.
 
+        The install script always installs the ccdc channel/package pairs it is
+        given in a single conda transaction. Set fold_ccdc_packages to make that
+        transaction the same one that installs the required conda packages
+        (this can be overridden with CCDC_FOLD_PACKAGES when running the script).
+
+        Set precompile_bytecode to False to generate an install script that does not
+        compile the site-packages bytecode once the packages are installed
+        (this can be overridden with CCDC_PRECOMPILE when running the script).
+
+        Use slim_packages to specify a list of package names (e.g. scipy, pandas)
+        whose archives are repacked in the offline channel without the files
+        matching slim_patterns (by default tests, static libraries, headers and docs).
+
+        The CPU, memory, disk and network use of the miniconda installer and conda
+        processes is sampled every resource_sample_interval seconds (None disables it)
+        and written next to the output directory at the end of the build.
+
         '''
         self.prefix = prefix
         self.extra_conda_packages = extra_conda_packages if extra_conda_packages else []
+        self.fold_ccdc_packages = fold_ccdc_packages
+        self.precompile_bytecode = precompile_bytecode
+        self.slim_packages = slim_packages if slim_packages else []
+        self.slim_patterns = slim_patterns if slim_patterns else DEFAULT_SLIM_PATTERNS
+        self.resource_monitor = ResourceMonitor(resource_sample_interval)
         self.extensions = {
             'Windows': 'exe',
             'Linux': 'sh',
@@ -273,6 +306,26 @@ class MinicondaOfflineInstaller:
         '''The output directory, where the installer and the offline channel end up'''
         return os.path.join('output', self.artefact_id)
 
+    @property
+    def resource_usage_prefix(self):
+        '''where the resource usage samples go, outside the output directory so that they are not distributed'''
+        return os.path.join('output', self.artefact_id + '-resources')
+
+    @property
+    def manifest_name(self):
+        '''the manifest is named without the build id, so that a plan can find the one of the last build'''
+        return self.name + '-' + build_osname() + '-manifest.json'
+
+    @property
+    def output_manifest(self):
+        '''the packages in the offline channel, used to compare a plan with the last build'''
+        return os.path.join('output', self.manifest_name)
+
+    @property
+    def plan_base_conda_meta(self):
+        '''a copy of the conda-meta directory of the freshly installed miniconda, used to solve without installing it again'''
+        return os.path.join(self.build_install_dir, 'plan-base', 'conda-meta')
+
     @property
     def output_installer(self):
         '''local path to the miniconda installer'''
@@ -325,26 +378,26 @@ class MinicondaOfflineInstaller:
         except:
             pass
 
-    def conda_cleanup(self, *package_specs):
+    def conda_cleanup(self, *package_specs, stage='Remove conda packages that were part of the installer'):
         """Remove package archives (so that we don't distribute them as they are already part of the installer)
         """
-        self._run_pkg_manager('conda', ['clean', '-y', '-q', '--all'])
+        self._run_pkg_manager('conda', ['clean', '-y', '-q', '--all'], stage=stage)
 
-    def conda_update_all(self):
+    def conda_update_all(self, stage='Download updates so that we can distribute them consistently'):
         """Update local packages that are part of the installer
         """
-        self._run_pkg_manager('conda', ['update', '-y', '-q', '--all'])
+        self._run_pkg_manager('conda', ['update', '-y', '-q', '--all'], stage=stage)
 
-    def conda_update_conda(self):
+    def conda_update_conda(self, stage='Update conda'):
         """Update local packages that are part of the installer
         """
-        self._run_pkg_manager('conda', ['update', '-y', '-q', 'conda'])
+        self._run_pkg_manager('conda', ['update', '-y', '-q', 'conda'], stage=stage)
 
-    def conda_install_download_only(self, *package_specs):
+    def conda_install_download_only(self, *package_specs, stage='Download packages'):
         """Download a conda package given its specifications.
         E.g. self.conda_install('numpy==1.9.2', 'lxml')
         """
-        self._run_pkg_manager('conda', ['install', '-y', '--download-only', '-q'], *package_specs)
+        self._run_pkg_manager('conda', ['install', '-y', '--download-only', '-q'], *package_specs, stage=stage)
 
     def package_name(self, package_filename):
         """Return the bit of a filename before the version number starts
@@ -364,7 +417,7 @@ class MinicondaOfflineInstaller:
         else:
             return 'linux-64'
 
-    def conda_index(self, channel):
+    def conda_index(self, channel, stage='Create index of offline channel'):
         """index the conda channel directory, uses a repo of magic fixes
         as discussed in https://ccdc-cambridge.slack.com/archives/C1JRZPULU/p1576008379426900
         Also comments out the addition of _libgcc_mutex from main as we only use conda-forge on linux
@@ -381,7 +434,7 @@ class MinicondaOfflineInstaller:
         with open(updated_patch_file, 'w') as f:
             f.write(s)
 
-        self._run_pkg_manager('conda', ['index', '--no-progress', '-p', updated_patch_file, channel])
+        self._run_pkg_manager('conda', ['index', '--no-progress', '-p', updated_patch_file, channel], stage=stage)
 
     def copy_packages(self):
         """Copy packages from the miniconda install to the final installer location
@@ -404,6 +457,74 @@ class MinicondaOfflineInstaller:
         for p in sorted(os.listdir(conda_package_dest)):
             print(f'  - {p}')
 
+        self.write_manifest(conda_package_dest)
+
+    def write_manifest(self, conda_package_dest):
+        """Record the name, version, build and size of every package in the offline channel,
+        and whether it is the archive installed in the build environment (older archives of a package can stay in the channel)
+        """
+        installed = set()
+        for record_filename in glob.glob(os.path.join(self.build_install_dir, 'conda-meta', '*.json')):
+            with open(record_filename) as f:
+                record = json.load(f)
+            installed.add(record.get('fn') or record.get('url', '').rsplit('/', 1)[-1])
+        manifest = {}
+        for filename in sorted(os.listdir(conda_package_dest)):
+            if not filename.endswith(('.tar.bz2', '.conda')):
+                continue
+            name, version, build = self.split_package_filename(filename)
+            manifest[filename] = {
+                'name': name,
+                'version': version,
+                'build': build,
+                'size': os.path.getsize(os.path.join(conda_package_dest, filename)),
+                'current': filename in installed,
+            }
+        with open(self.output_manifest, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def slim_offline_channel(self):
+        """Repack the slim_packages archives of the offline channel without the files matching slim_patterns
+        """
+        conda_package_dest = os.path.join(self.output_conda_offline_channel, self.channel_arch())
+        packages = []
+        skipped = []
+        for filename in sorted(os.listdir(conda_package_dest)):
+            if self.split_package_filename(filename)[0] not in self.slim_packages:
+                continue
+            if can_slim(filename):
+                packages.append(os.path.join(conda_package_dest, filename))
+            else:
+                skipped.append(filename)
+        if skipped:
+            print(f'##vso[task.logissue type=warning]Not slimming {len(skipped)} of {len(packages) + len(skipped)} packages, '
+                  f'.conda packages need zstandard: {", ".join(skipped)}', flush=True)
+
+        total_saved = 0
+        total_extraction_time_saved = 0.0
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = executor.map(slim_package, packages, [self.slim_patterns] * len(packages))
+            for package, (saved, removed, extract_before, extract_after) in zip(packages, results):
+                print(f'  - {os.path.basename(package)}: removed {removed} files, {saved / 2**20:.1f}MB smaller, '
+                      f'archive extraction (tarfile) {extract_after:.1f}s instead of {extract_before:.1f}s')
+                total_saved += saved
+                total_extraction_time_saved += extract_before - extract_after
+        print(f'Slimming saved {total_saved / 2**20:.1f}MB and {total_extraction_time_saved:.1f}s of archive extraction with tarfile '
+              f'(not a timed conda install)')
+
+        self.write_manifest(conda_package_dest)
+
+    def split_package_filename(self, package_filename):
+        """Return the name, version and build of a conda package filename
+        """
+        stem = re.sub(r'(\.tar\.bz2|\.conda)$', '', package_filename)
+        return tuple(stem.rsplit('-', 2))
+
+    def snapshot_base_environment(self):
+        """Keep the package records of the freshly installed miniconda so that plan() can solve against them
+        """
+        shutil.copytree(os.path.join(self.build_install_dir, 'conda-meta'), self.plan_base_conda_meta)
+
     windows_install_script = """@echo off
 if "%~1"=="" (
   echo "install target_dir [ccdc_packages_and_package_name_pairs...]"
@@ -412,27 +533,55 @@ if "%~1"=="" (
 setlocal
 set installer_dir=%~dps0
 set target_miniconda=%~1
+rem Set CCDC_FOLD_PACKAGES=1 to install the ccdc packages in the same transaction as the required packages
+if not defined CCDC_FOLD_PACKAGES set CCDC_FOLD_PACKAGES={{ fold_ccdc_packages }}
+rem Set CCDC_PRECOMPILE=0 to skip compiling the python bytecode of the installed packages
+if not defined CCDC_PRECOMPILE set CCDC_PRECOMPILE={{ precompile_bytecode }}
+rem Set CCDC_CONDA_CHANNEL to the URL of a served offline channel to install from it instead of the local copy
+if defined CCDC_CONDA_CHANNEL (
+    set conda_channel=%CCDC_CONDA_CHANNEL%
+    set conda_offline=
+) else (
+    set conda_channel=%installer_dir%conda_offline_channel
+    set conda_offline=--offline
+)
 echo "CCDC Miniconda installer: running installer"
 start /wait "" "%installer_dir%{{ installer_exe }}" /AddToPath=0 /S /D=%~s1
 if errorlevel 1 (
    echo Miniconda failed to install: %errorlevel%
    exit /b %errorlevel%
 )
+rem Collect the ccdc channel/package pairs so that they are all installed in a single conda transaction
+shift
+set ccdc_channels=
+set ccdc_packages=
+:next_package
+if "%~2" == "" goto collected_packages
+set ccdc_channels=%ccdc_channels% --channel "%installer_dir%%~1_conda_channel"
+set ccdc_packages=%ccdc_packages% %2
+shift
+shift
+goto next_package
+:collected_packages
 echo "CCDC Miniconda installer: activating conda environment"
 call "%target_miniconda%\\Scripts\\activate"
 echo "CCDC Miniconda installer: updating conda"
-call conda update -y --channel "%installer_dir%conda_offline_channel" --offline --override-channels -q conda
+call conda update -y --channel "%conda_channel%" %conda_offline% --override-channels -q conda
 echo "CCDC Miniconda installer: updating all packages"
-call conda update -y --channel "%installer_dir%conda_offline_channel" --offline --override-channels -q --all
+call conda update -y --channel "%conda_channel%" %conda_offline% --override-channels -q --all
 echo "CCDC Miniconda installer: installing required packages"
-call conda install -y --channel "%installer_dir%conda_offline_channel" --offline --override-channels -q {{ conda_packages }}
-shift
-:next_package
-if not "%1" == "" (
-    call conda install -y --channel "%installer_dir%%1_conda_channel" --offline --override-channels -q %2
-    shift
-    shift
-    goto next_package
+if "%CCDC_FOLD_PACKAGES%" == "1" (
+    call conda install -y --channel "%conda_channel%" %ccdc_channels% %conda_offline% --override-channels -q {{ conda_packages }} %ccdc_packages%
+) else (
+    call conda install -y --channel "%conda_channel%" %conda_offline% --override-channels -q {{ conda_packages }}
+    if defined ccdc_packages (
+        echo "CCDC Miniconda installer: installing%ccdc_packages%"
+        call conda install -y %ccdc_channels% --offline --override-channels -q %ccdc_packages%
+    )
+)
+if "%CCDC_PRECOMPILE%" == "1" (
+    echo "CCDC Miniconda installer: precompiling python bytecode"
+    call python -m compileall -q -j 0 "%target_miniconda%\\Lib\\site-packages"
 )
 echo "CCDC Miniconda installer: copying condarc"
 copy "%installer_dir%\\condarc-for-offline-installer-creation" "%target_miniconda%\\condarc"
@@ -447,6 +596,14 @@ if test $# -eq 0 ; then
 fi
 INSTALLER_DIR=$(dirname -- "$0")
 TARGET_MINICONDA=$1
+# Set CCDC_FOLD_PACKAGES=1 to install the ccdc packages in the same transaction as the required packages
+CCDC_FOLD_PACKAGES=${CCDC_FOLD_PACKAGES:-{{ fold_ccdc_packages }}}
+# Set CCDC_PRECOMPILE=0 to skip compiling the python bytecode of the installed packages
+CCDC_PRECOMPILE=${CCDC_PRECOMPILE:-{{ precompile_bytecode }}}
+# Set CCDC_CONDA_CHANNEL to the URL of a served offline channel to install from it instead of the local copy
+CONDA_CHANNEL=${CCDC_CONDA_CHANNEL:-$INSTALLER_DIR/conda_offline_channel}
+CONDA_OFFLINE=--offline
+test -z "$CCDC_CONDA_CHANNEL" || CONDA_OFFLINE=
 chmod +x "$INSTALLER_DIR/{{ installer_exe }}"
 unset PYTHONPATH
 unset PYTHONHOME
@@ -455,24 +612,47 @@ echo "CCDC Miniconda installer: running installer"
 echo "CCDC Miniconda installer: activating conda environment"
 . "$TARGET_MINICONDA/bin/activate" ""
 echo 'CCDC Miniconda installer: Updating conda'
-conda update -y --channel "$INSTALLER_DIR/conda_offline_channel" --offline --override-channels -q conda
+conda update -y --channel "$CONDA_CHANNEL" $CONDA_OFFLINE --override-channels -q conda
 [ $? -eq 0 ] || exit $?; # exit if non-zero return code
 echo 'CCDC Miniconda installer: Updating all packages'
-conda update -y --channel "$INSTALLER_DIR/conda_offline_channel" --offline --override-channels -q --all
-[ $? -eq 0 ] || exit $?; # exit if non-zero return code
-echo 'CCDC Miniconda installer: Installing required packages'
-conda install -y --channel "$INSTALLER_DIR/conda_offline_channel" --offline --override-channels -q {{ conda_packages }}
+conda update -y --channel "$CONDA_CHANNEL" $CONDA_OFFLINE --override-channels -q --all
 [ $? -eq 0 ] || exit $?; # exit if non-zero return code
 
+# Collect the ccdc channel/package pairs so that they are all installed in a single conda transaction.
+# The positional parameters are replaced by the --channel arguments, the packages go in CCDC_PACKAGES
 shift
-while test $# -gt 1
+CCDC_PACKAGES=''
+CCDC_PAIRS=$(( $# / 2 ))
+CCDC_UNPAIRED=$(( $# % 2 ))
+while test $CCDC_PAIRS -gt 0
 do
-    echo "CCDC Miniconda installer: Installing $2"
-    conda install -y --channel "$INSTALLER_DIR/$1_conda_channel" --offline --override-channels -q $2
-    [ $? -eq 0 ] || exit $?; # exit if non-zero return code
-    shift
-    shift
+    CCDC_PACKAGES="$CCDC_PACKAGES $2"
+    set -- "$@" --channel "$INSTALLER_DIR/$1_conda_channel"
+    shift 2
+    CCDC_PAIRS=$(( CCDC_PAIRS - 1 ))
 done
+test $CCDC_UNPAIRED -eq 0 || shift
+
+echo 'CCDC Miniconda installer: Installing required packages'
+if test "$CCDC_FOLD_PACKAGES" = "1" ; then
+    conda install -y --channel "$CONDA_CHANNEL" "$@" $CONDA_OFFLINE --override-channels -q {{ conda_packages }} $CCDC_PACKAGES
+else
+    conda install -y --channel "$CONDA_CHANNEL" $CONDA_OFFLINE --override-channels -q {{ conda_packages }}
+fi
+[ $? -eq 0 ] || exit $?; # exit if non-zero return code
+
+if test "$CCDC_FOLD_PACKAGES" != "1" && test -n "$CCDC_PACKAGES" ; then
+    echo "CCDC Miniconda installer: Installing$CCDC_PACKAGES"
+    conda install -y "$@" --offline --override-channels -q $CCDC_PACKAGES
+    [ $? -eq 0 ] || exit $?; # exit if non-zero return code
+fi
+
+# Compile the bytecode now, on all cores, rather than on the first import of each module.
+# Failures are not fatal, python falls back to compiling on import
+if test "$CCDC_PRECOMPILE" = "1" ; then
+    echo 'CCDC Miniconda installer: Precompiling python bytecode'
+    python -m compileall -q -j 0 "$(python -c 'import sysconfig; print(sysconfig.get_paths()["purelib"])')" || echo 'CCDC Miniconda installer: some modules could not be precompiled'
+fi
 echo "CCDC Miniconda installer: copying condarc"
 cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/condarc"
 """
@@ -486,6 +666,8 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
         if self.prefix is not None:
             installer_name = self.prefix + '-' + installer_name
         script = script.replace('{{ installer_exe }}', '"'+installer_name+'"')
+        script = script.replace('{{ fold_ccdc_packages }}', '1' if self.fold_ccdc_packages else '0')
+        script = script.replace('{{ precompile_bytecode }}', '1' if self.precompile_bytecode else '0')
         script = script.replace('{{ conda_packages }}', ' '.join(['"'+pkg+'"' for pkg in required_offline_conda_packages(self.prefix, self.extra_conda_packages)]))
         with open(self.install_script_path, "w") as f:
             f.write(script)
@@ -493,23 +675,145 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
             os.chmod(self.install_script_path, 0o755)
         shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'condarc-for-offline-installer-creation'), self.output_dir)
 
-    def test_install_script(self):
+    def write_stub_ccdc_channels(self, count):
+        """Create channels named like the ccdc package channels, each holding an empty noarch package.
+        Returns the ccdc_packages_and_package_name_pairs to pass to the install script.
+        """
+        pairs = []
+        for i in range(count):
+            name = f'ccdc-stub-{i}'
+            channel = os.path.join(self.output_dir, f'{name}_conda_channel')
+            os.makedirs(os.path.join(channel, self.channel_arch()))
+            os.makedirs(os.path.join(channel, 'noarch'))
+            index = {
+                'name': name,
+                'version': '1.0',
+                'build': '0',
+                'build_number': 0,
+                'depends': [],
+                'license': 'Proprietary',
+                'noarch': 'generic',
+                'subdir': 'noarch',
+            }
+            with tarfile.open(os.path.join(channel, 'noarch', f'{name}-1.0-0.tar.bz2'), 'w:bz2') as tar:
+                for member_name, content in [
+                        ('info/index.json', json.dumps(index)),
+                        ('info/paths.json', json.dumps({'paths': [], 'paths_version': 1})),
+                        ('info/files', ''),
+                        ]:
+                    data = content.encode()
+                    member = tarfile.TarInfo(member_name)
+                    member.size = len(data)
+                    member.mtime = time.time()
+                    tar.addfile(member, io.BytesIO(data))
+            self._run_pkg_manager('conda', ['index', '--no-progress', channel], stage='Create stub ccdc channels')
+            pairs += [name, name]
+        return pairs
+
+    def time_ccdc_package_installs(self, target_miniconda, ccdc_pairs):
+        """Compare one conda transaction per ccdc channel/package pair with a single transaction for all of them
+        """
+        conda = self._args_for('conda', target_miniconda)
+        env = self._pkg_manager_env(target_miniconda)
+        channels = [os.path.abspath(os.path.join(self.output_dir, f'{name}_conda_channel')) for name in ccdc_pairs[0::2]]
+        packages = ccdc_pairs[1::2]
+        offline_args = ['-y', '-q', '--offline', '--override-channels']
+        remove_args = [conda, 'remove'] + offline_args + ['--channel', os.path.abspath(self.output_conda_offline_channel)] + packages
+
+        monitor = self.resource_monitor
+        monitor.check_call(remove_args, 'Remove ccdc packages', env=env)
+        start = time.perf_counter()
+        for channel, package in zip(channels, packages):
+            monitor.check_call([conda, 'install'] + offline_args + ['--channel', channel, package],
+                               'Install ccdc packages one transaction at a time', env=env)
+        per_pair = time.perf_counter() - start
+
+        monitor.check_call(remove_args, 'Remove ccdc packages', env=env)
+        start = time.perf_counter()
+        monitor.check_call([conda, 'install'] + offline_args + [arg for channel in channels for arg in ('--channel', channel)] + packages,
+                           'Install ccdc packages in a single transaction', env=env)
+        single = time.perf_counter() - start
+
+        print(f'Installing {len(packages)} ccdc packages: {per_pair:.1f}s with one transaction per package, '
+              f'{single:.1f}s in a single transaction ({per_pair / single:.1f}x faster)')
+
+    def run_smoke_test(self, target_miniconda, write_bytecode=True):
+        '''Run the smoke test in an installed environment and return the import time it reports'''
+        if sys.platform == 'win32':
+            test_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smoke_test.bat')
+        else:
+            test_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smoke_test.sh')
+        env = os.environ.copy()
+        if not write_bytecode:
+            # behave like a read-only install, where every session has to compile the bytecode again
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+        args = [test_script, target_miniconda, self.prefix if self.prefix is not None else 'full']
+        result = subprocess.run(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        print(result.stdout)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, args)
+        import_time = re.search(r'Import time: ([\d.]+)s', result.stdout)
+        return float(import_time.group(1)) if import_time else None
+
+    def time_smoke_test(self, target_miniconda):
+        '''Import time of the smoke test in an installed environment, without writing any bytecode.
+        The first run only warms up the page cache, so that environments can be compared
+        '''
+        self.run_smoke_test(target_miniconda, write_bytecode=False)
+        return self.run_smoke_test(target_miniconda, write_bytecode=False)
+
+    def run_install_script(self, target_miniconda, ccdc_pairs=(), stage='Test install script', **env_overrides):
+        '''Run the install script into target_miniconda, with the given environment variables'''
+        args = [
+            os.path.abspath(self.install_script_path),
+            target_miniconda
+        ] + list(ccdc_pairs)
+        print(args)
+        print(self.output_dir)
+        self.resource_monitor.check_call(args, stage, cwd=self.output_dir, env=dict(os.environ, **env_overrides))
+        print('Finished install successfully')
+
+    def run_install_script_from_server(self, target_miniconda, ccdc_pairs=(), stage='Test install script over HTTP', **env_overrides):
+        '''Run the install script with CCDC_CONDA_CHANNEL pointing at the output directory served on 127.0.0.1'''
+        with make_server(self.output_dir, '127.0.0.1', 0, verbose=False) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                channel_url = f'http://127.0.0.1:{server.server_address[1]}/conda_offline_channel'
+                self.run_install_script(target_miniconda, ccdc_pairs, stage, CCDC_CONDA_CHANNEL=channel_url, **env_overrides)
+            finally:
+                server.shutdown()
+
+    def test_install_script(self, stub_ccdc_channels=4):
         '''Run the install script on a temporary directory'''
         with tempfile.TemporaryDirectory() as tmpdirname:
-            args = [
-                os.path.abspath(self.install_script_path),
-                os.path.join(tmpdirname, 'miniconda')
-            ]
-            print(args)
-            print(self.output_dir)
-            subprocess.check_call(args, cwd=self.output_dir)
-            print('Finished install successfully')
-
-            if sys.platform == 'win32':
-                test_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smoke_test.bat')
-            else:
-                test_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smoke_test.sh')
-            subprocess.check_call([test_script, os.path.join(tmpdirname, 'miniconda'), self.prefix if self.prefix is not None else 'full'])
+            target_miniconda = os.path.join(tmpdirname, 'miniconda')
+            served_miniconda = os.path.join(tmpdirname, 'served-miniconda')
+            try:
+                ccdc_pairs = self.write_stub_ccdc_channels(stub_ccdc_channels)
+                # the script as it is shipped, without any environment overrides
+                self.run_install_script(target_miniconda, ccdc_pairs)
+                if ccdc_pairs:
+                    self.time_ccdc_package_installs(target_miniconda, ccdc_pairs)
+
+                # the second install fetches the packages over HTTP, as machines on the LAN would from serve,
+                # installs the CCDC packages in the same conda command as the updates and does not precompile,
+                # which gives the import time to compare with
+                self.run_install_script_from_server(served_miniconda, ccdc_pairs, CCDC_FOLD_PACKAGES='1', CCDC_PRECOMPILE='0')
+            finally:
+                # the stub channels must not end up in the artefact, even if creating them failed part-way
+                for channel in glob.glob(os.path.join(self.output_dir, 'ccdc-stub-*_conda_channel')):
+                    shutil.rmtree(channel, ignore_errors=True)
+
+            if not self.precompile_bytecode:
+                self.run_smoke_test(target_miniconda)
+                self.run_smoke_test(served_miniconda)
+                return
+            before = self.time_smoke_test(served_miniconda)
+            after = self.time_smoke_test(target_miniconda)
+            if before is not None and after is not None:
+                print(f'Import time in smoke_test.py without writing bytecode: {before:.2f}s when installed without precompiling, '
+                      f'{after:.2f}s when installed with it')
 
     def pin_python_version(self):
         pinned_python = 'python 3.7'
@@ -519,7 +823,7 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
 
     def install_miniconda(self):
         print('Running %s' % self.install_args)
-        outcome = subprocess.call(self.install_args)
+        outcome = self.resource_monitor.call(self.install_args, 'Install miniconda in the build directory')
 
         if IS_WINDOWS:
             self._clean_up_system_path()
@@ -556,29 +860,36 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
                                 'PATH')
         broadcast_environment_settings_change()
 
-    def conda_install(self, *package_specs):
+    def conda_install(self, *package_specs, stage='Install packages'):
         """Install a conda package given its specifications.
-        E.g. self.conda_install('numpy==1.9.2', 'lxml')
+        E.g. self.conda_install('numpy==1.9.2', 'lxml', stage='Fetch packages')
         """
-        self._run_pkg_manager('conda', ['install', '-y', '-q'], *package_specs)
+        self._run_pkg_manager('conda', ['install', '-y', '-q'], *package_specs, stage=stage)
 
-    def _run_pkg_manager(self, pkg_manager_name, extra_args, *package_specs):
+    def _pkg_manager_env(self, install_dir=None):
         my_env = os.environ.copy()
         # Set the condarc to the channels we want
         my_env["CONDARC"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'condarc-for-offline-installer-creation')
         # add Library\bin to path so that conda can find libcrypto
         if IS_WINDOWS:
-            my_env['PATH'] = "%s;%s" % (os.path.join(self.build_install_dir, 'Library', 'bin'), my_env['PATH'])
+            install_dir = install_dir if install_dir is not None else self.build_install_dir
+            my_env['PATH'] = "%s;%s" % (os.path.join(install_dir, 'Library', 'bin'), my_env['PATH'])
+        return my_env
+
+    def _run_pkg_manager(self, pkg_manager_name, extra_args, *package_specs, stage):
+        """Run the package manager of the build environment, its resource usage is reported under stage
+        """
+        my_env = self._pkg_manager_env()
         args = [self._args_for(pkg_manager_name)] + extra_args + list(package_specs)
-        outcome = subprocess.call(args, env=my_env)
+        outcome = self.resource_monitor.call(args, stage, env=my_env)
         if outcome != 0:
             print('_run_pkg_manager fail info')
             print(args)
             print(my_env)
             raise RuntimeError('Could not install {0} with {1}'.format(' '.join(package_specs), pkg_manager_name))
 
-    def _args_for(self, executable_name):
-        return os.path.join(self.build_install_dir,
+    def _args_for(self, executable_name, install_dir=None):
+        return os.path.join(install_dir if install_dir is not None else self.build_install_dir,
                             ('Scripts' if IS_WINDOWS else 'bin'),
                             executable_name + ('.exe' if IS_WINDOWS else ''))
 
@@ -598,6 +909,107 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
             if os.path.exists(os.path.expanduser(path)):
                 print('Conda configuration found in %s. This might affect installation of packages' % path)
 
+    def _version_key(self, version):
+        """A sort key that orders the usual conda version strings, numbers sort after letters as in conda
+        """
+        return [(1, int(part), '') if part.isdigit() else (0, 0, part) for part in re.split(r'[._+-]', version.lower())]
+
+    def _package_size(self, filename, fetch_sizes, manifest):
+        """The size of a package archive, from the package cache, the solver or the manifest of the last build
+        """
+        cached_package = os.path.join(self.build_install_dir, 'pkgs', filename)
+        if os.path.exists(cached_package):
+            return os.path.getsize(cached_package)
+        if filename in fetch_sizes:
+            return fetch_sizes[filename]
+        return manifest.get(filename, {}).get('size', 0)
+
+    def plan(self, manifest_dir=None):
+        """Predict the offline channel without building it.
+        Solves the required packages against the base environment and repodata cached by the last build,
+        then prints the packages that would be added, removed or changed compared with the last build's manifest,
+        looked for in manifest_dir (by default, where the last local build wrote it)
+        """
+        manifest_path = os.path.join(manifest_dir, self.manifest_name) if manifest_dir is not None else self.output_manifest
+        if not os.path.exists(self._args_for('conda')) or not os.path.isdir(self.plan_base_conda_meta):
+            raise RuntimeError(f'Planning needs the miniconda install left in {self.build_install_dir} by a previous build')
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        else:
+            print(f'No manifest found in {manifest_path}, every package will be reported as added')
+
+        print(f'##[group]Plan for prefix={self.prefix}', flush=True)
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            # conda only needs the package records of an environment to solve an update of it
+            shutil.copytree(self.plan_base_conda_meta, os.path.join(tmpdirname, 'conda-meta'))
+            args = [self._args_for('conda'), 'install', '--dry-run', '--json', '-q', '--use-index-cache',
+                    '--update-all', '-p', tmpdirname] + required_offline_conda_packages(self.prefix, self.extra_conda_packages)
+            result = subprocess.run(args, env=self._pkg_manager_env(), stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            solution = json.loads(result.stdout)
+        except ValueError:
+            raise RuntimeError(f'Could not solve with {args}:\n{result.stdout}')
+        if 'error' in solution or 'exception_name' in solution:
+            raise RuntimeError(f"Could not solve with {args}: {solution.get('message', solution.get('error'))}")
+
+        actions = solution.get('actions', {})
+        fetch_sizes = {record['fn']: record.get('size', 0) for record in actions.get('FETCH', []) if 'fn' in record}
+        # the channel ends up with every package that was not part of the miniconda installer
+        planned = {}
+        for record in actions.get('LINK', []):
+            build = record.get('build_string', record.get('build'))
+            stem = record.get('dist_name', f"{record['name']}-{record['version']}-{build}")
+            # LINK records do not say which archive format the package comes in
+            candidates = [stem + '.conda', stem + '.tar.bz2']
+            filename = next((fn for fn in candidates if fn in fetch_sizes), None) \
+                or next((fn for fn in candidates if os.path.exists(os.path.join(self.build_install_dir, 'pkgs', fn))), None) \
+                or next((fn for fn in candidates if fn in manifest), stem + '.tar.bz2')
+            planned[record['name']] = {'filename': filename, 'version': record['version'], 'build': build}
+
+        # compare with the archives the last build installed; manifests without 'current' fall back to the highest version
+        last_build = {}
+        for filename, package in sorted(manifest.items(), key=lambda item: self._version_key(item[1]['version'])):
+            if package.get('current', True):
+                last_build[package['name']] = dict(package, filename=filename)
+
+        added = sorted(set(planned) - set(last_build))
+        removed = sorted(set(last_build) - set(planned))
+        changed = []
+        for name in sorted(set(planned) & set(last_build)):
+            old, new = last_build[name], planned[name]
+            if (old['version'], old['build']) == (new['version'], new['build']):
+                continue
+            if old['version'] == new['version']:
+                change = 'rebuilt'
+            elif self._version_key(new['version']) > self._version_key(old['version']):
+                change = 'upgraded'
+            else:
+                change = 'downgraded'
+            changed.append((name, change, f"{old['version']}-{old['build']}", f"{new['version']}-{new['build']}"))
+
+        for name in added:
+            print(f"  + {name} {planned[name]['version']}-{planned[name]['build']}")
+        for name in removed:
+            print(f"  - {name} {last_build[name]['version']}-{last_build[name]['build']}")
+        for name, change, old, new in changed:
+            print(f'  ~ {name} {old} -> {new} ({change})')
+
+        sizes = {name: self._package_size(package['filename'], fetch_sizes, manifest) for name, package in planned.items()}
+        download = sum(size for name, size in sizes.items() if planned[name]['filename'] not in manifest)
+        channel_size = sum(sizes.values())
+        last_channel_size = sum(package['size'] for package in manifest.values())
+        installer_size = os.path.getsize(self.output_installer) if os.path.exists(self.output_installer) else 0
+        print(f'{len(added)} added, {len(removed)} removed, {len(changed)} changed, {len(planned)} packages in the offline channel')
+        print(f'Estimated download of new package files: {download / 2**20:.1f}MB')
+        print(f'Estimated artefact size: {(channel_size + installer_size) / 2**20:.1f}MB '
+              f'(offline channel {channel_size / 2**20:.1f}MB, last build {last_channel_size / 2**20:.1f}MB)')
+        print(f'Planned in {time.perf_counter() - start:.1f}s')
+        print('##[endgroup]')
+        return added, removed, changed
+
     def build(self):
         # Set the variable in the azure pipeline so that the archiving stage later can pick up the right version
         print(f"##vso[task.setvariable variable=miniconda_installer_version]{miniconda_installer_version()}", flush=True)
@@ -625,22 +1037,23 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
         print('##[endgroup]')
 
         print('##[group]Remove conda packages that were part of the installer', flush=True)
-        self.conda_cleanup()
+        self.conda_cleanup(stage='Remove conda packages that were part of the installer')
+        self.snapshot_base_environment()
         time.sleep(0.5)
         print('##[endgroup]')
 
         print('##[group]Update conda', flush=True)
-        self.conda_update_conda()
+        self.conda_update_conda(stage='Update conda')
         time.sleep(0.5)
         print('##[endgroup]')
 
         print('##[group]Fetch packages', flush=True)
-        self.conda_install(*required_offline_conda_packages(self.prefix, self.extra_conda_packages))
+        self.conda_install(*required_offline_conda_packages(self.prefix, self.extra_conda_packages), stage='Fetch packages')
         time.sleep(0.5)
         print('##[endgroup]')
 
         print('##[group]Download updates so that we can distribute them consistently', flush=True)
-        self.conda_update_all()
+        self.conda_update_all(stage='Download updates so that we can distribute them consistently')
         time.sleep(0.5)
         print('##[endgroup]')
 
@@ -659,13 +1072,19 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
         time.sleep(0.5)
         print('##[endgroup]')
 
+        if self.slim_packages:
+            print('##[group]Slim package archives in the offline channel', flush=True)
+            self.slim_offline_channel()
+            time.sleep(0.5)
+            print('##[endgroup]')
+
         print('##[group]Install conda-build in order to index the offline channel', flush=True)
-        self.conda_install('conda-build')
+        self.conda_install('conda-build', stage='Install conda-build')
         time.sleep(0.5)
         print('##[endgroup]')
 
         print('##[group]Create index of offline channel', flush=True)
-        self.conda_index(self.output_conda_offline_channel)
+        self.conda_index(self.output_conda_offline_channel, stage='Create index of offline channel')
         time.sleep(0.5)
         print('##[endgroup]')
 
@@ -679,11 +1098,40 @@ cp "$INSTALLER_DIR/condarc-for-offline-installer-creation" "$TARGET_MINICONDA/co
         time.sleep(0.5)
         print('##[endgroup]')
 
+        print('##[group]Resource usage of the conda processes', flush=True)
+        self.resource_monitor.write(self.resource_usage_prefix)
+        print('##[endgroup]')
+
 if __name__ == '__main__':
-    # To be used in the webcsd-csp installer for landscape report generation
-    MinicondaOfflineInstaller(
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', nargs='?', default='build', choices=['build', 'plan', 'serve'],
+                        help='build the offline installers (default), plan: solve only and compare with the last build, '
+                             'or serve: publish the last build of one installer over HTTP')
+    installers = [
+        # To be used in the webcsd-csp installer for landscape report generation
+        MinicondaOfflineInstaller(
             prefix='webcsd-csp',
             extra_conda_packages=['docxtpl==0.11.5', 'matplotlib-base==3.4.3']
-            ).build()
-    MinicondaOfflineInstaller().build()
+            ),
+        MinicondaOfflineInstaller(),
+    ]
+    parser.add_argument('--prefix', choices=[installer.prefix for installer in installers if installer.prefix is not None],
+                        help='serve the installer with this prefix rather than the full one')
+    parser.add_argument('--host', help='address to serve on (default: all interfaces)')
+    parser.add_argument('--port', type=int, help='port to serve on (default: 8000)')
+    parser.add_argument('--manifest-dir', help='plan against the manifests of the last build found in this directory (default: output)')
+    args = parser.parse_args()
+    for option, command in [('prefix', 'serve'), ('host', 'serve'), ('port', 'serve'), ('manifest_dir', 'plan')]:
+        if getattr(args, option) is not None and args.command != command:
+            parser.error(f"--{option.replace('_', '-')} can only be used with {command}")
+
+    if args.command == 'serve':
+        installer = next(installer for installer in installers if installer.prefix == args.prefix)
+        serve(installer.output_dir, args.host if args.host is not None else '', args.port if args.port is not None else 8000)
+    elif args.command == 'plan':
+        for installer in installers:
+            installer.plan(args.manifest_dir)
+    else:
+        for installer in installers:
+            installer.build()
 
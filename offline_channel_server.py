@@ -0,0 +1,245 @@
+"""Serve an offline installer directory (output/<artefact_id>) over HTTP, so that machines on the LAN can install
+from a single copy of it and only fetch the packages they need.
+Run the generated install script with CCDC_CONDA_CHANNEL=http://<host>:<port>/conda_offline_channel to use it.
+
+The server keeps connections alive, answers Range requests and sends gzipped repodata to clients that accept it.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import email.utils
+import gzip
+import http.client
+import http.server
+import io
+import os
+import random
+import re
+import statistics
+import threading
+import time
+
+REPODATA_FILES = ('repodata.json', 'current_repodata.json')
+
+
+class CompressedRepodata:
+    '''The repodata files of a directory, gzipped in memory so that the directory itself can be read-only'''
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.compressed = {}
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                if filename in REPODATA_FILES:
+                    self.get(os.path.join(root, filename))
+
+    def get(self, path):
+        '''the gzipped content of a repodata file, compressed again if the file has changed'''
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            entry = self.compressed.get(path)
+            if entry is None or entry[0] != mtime:
+                with open(path, 'rb') as f:
+                    entry = (mtime, gzip.compress(f.read()))
+                self.compressed[path] = entry
+        return entry[1]
+
+
+class _RangeFile:
+    '''A file object that reads length bytes from offset'''
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.f.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class OfflineChannelRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.isfile(path):
+            return super().send_head()
+
+        is_repodata = os.path.basename(path) in REPODATA_FILES
+        mtime = os.path.getmtime(path)
+        if self._not_modified_since(mtime):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+            if is_repodata:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return None
+
+        content_encoding = None
+        try:
+            if is_repodata and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                data = self.server.compressed_repodata.get(path)
+                f = io.BytesIO(data)
+                size = len(data)
+                content_encoding = 'gzip'
+            else:
+                f = open(path, 'rb')
+                size = os.fstat(f.fileno()).st_size
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        byte_range = self._byte_range(size)
+        if byte_range == 'unsatisfiable':
+            f.close()
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        if byte_range is None:
+            self.send_response(http.HTTPStatus.OK)
+            length = size
+        else:
+            start, end = byte_range
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            length = end - start + 1
+            f = _RangeFile(f, start, length)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        if is_repodata:
+            # caches must keep the gzipped and the plain repodata apart
+            self.send_header('Vary', 'Accept-Encoding')
+        if content_encoding is not None:
+            self.send_header('Content-Encoding', content_encoding)
+        self.end_headers()
+        return f
+
+    def _not_modified_since(self, mtime):
+        '''Whether a conditional GET can be answered with 304, as in SimpleHTTPRequestHandler'''
+        if 'If-Modified-Since' not in self.headers or 'If-None-Match' in self.headers:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        last_modified = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).replace(microsecond=0)
+        return last_modified <= since
+
+    def _byte_range(self, size):
+        '''(first, last) byte of a single Range request, None to send the whole file'''
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+        if match is None or match.groups() == ('', ''):
+            # no range, or several ranges, which we answer with the whole file
+            return None
+        first, last = match.groups()
+        if first == '':
+            # the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return 'unsatisfiable'
+        return start, end
+
+
+def make_server(directory, host='', port=8000, verbose=True):
+    class Handler(OfflineChannelRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.verbose = verbose
+    server.compressed_repodata = CompressedRepodata(directory)
+    return server
+
+
+def serve(directory, host='', port=8000):
+    '''Serve directory until interrupted'''
+    with make_server(directory, host, port) as server:
+        print(f'Serving {directory} on port {server.server_address[1]}, '
+              f'install with CCDC_CONDA_CHANNEL=http://<this host>:{server.server_address[1]}/conda_offline_channel')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def benchmark(directory, clients=32, requests_per_client=20, range_size=2**20):
+    '''Start a local server and have many clients fetch repodata and package ranges from it over keep-alive connections'''
+    urls = []
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename in REPODATA_FILES or filename.endswith(('.tar.bz2', '.conda')):
+                path = os.path.join(root, filename)
+                urls.append(('/' + os.path.relpath(path, directory).replace(os.sep, '/'), os.path.getsize(path)))
+    if not urls:
+        raise RuntimeError(f'No repodata or packages to fetch in {directory}')
+
+    with make_server(directory, '127.0.0.1', 0, verbose=False) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+
+        def client(seed):
+            rng = random.Random(seed)
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            latencies = []
+            received = 0
+            for _ in range(requests_per_client):
+                url, size = rng.choice(urls)
+                headers = {'Accept-Encoding': 'gzip'}
+                if size > range_size:
+                    start = rng.randrange(size - range_size)
+                    headers['Range'] = f'bytes={start}-{start + range_size - 1}'
+                request_start = time.perf_counter()
+                connection.request('GET', url, headers=headers)
+                response = connection.getresponse()
+                received += len(response.read())
+                latencies.append(time.perf_counter() - request_start)
+                if response.status not in (200, 206):
+                    raise RuntimeError(f'GET {url} returned {response.status}')
+            connection.close()
+            return latencies, received
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+            results = list(executor.map(client, range(clients)))
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    received = sum(client_received for _, client_received in results)
+    print(f'{clients} clients, {len(latencies)} requests in {elapsed:.2f}s: {len(latencies) / elapsed:.0f} requests/s, '
+          f'{received / 2**20 / elapsed:.1f}MB/s, latency median {statistics.median(latencies) * 1000:.1f}ms, '
+          f'95th percentile {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help='the output/<artefact_id> directory to serve')
+    parser.add_argument('--host', default='', help='address to listen on (default: all interfaces)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--benchmark', type=int, metavar='CLIENTS',
+                        help='instead of serving, measure a local server with this many parallel clients')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.directory, clients=args.benchmark)
+    else:
+        serve(args.directory, args.host, args.port)
@@ -0,0 +1,218 @@
+"""Repack conda packages without the files that the CSD scripts never use, e.g. test suites, static libraries and headers.
+Smaller archives make the offline channel smaller and the end user installs faster.
+.tar.bz2 packages are repacked with tarfile, .conda packages need zstandard (see requirements.txt) and are left as they are without it.
+"""
+import fnmatch
+import io
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# fnmatch patterns, matched against the path of each file in the package.
+# Packages for Windows keep their C/C++ files under Library/
+DEFAULT_SLIM_PATTERNS = [
+    '*/tests/*',
+    '*.a',
+    'include/*',
+    'share/doc/*',
+    'share/man/*',
+    'Library/include/*',
+    'Library/lib/*.lib',
+    'Library/share/doc/*',
+    'Library/share/man/*',
+]
+
+# higher levels compress little better and take much longer
+CONDA_COMPRESSION_LEVEL = 19
+
+
+def can_slim(package_path):
+    '''Whether slim_package can repack this archive'''
+    return package_path.endswith('.tar.bz2') or (package_path.endswith('.conda') and zstandard is not None)
+
+
+def _matches(path, patterns):
+    for pattern in patterns:
+        # a pattern like include/ means everything under that directory
+        if pattern.endswith('/'):
+            pattern += '*'
+        if fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
+
+def _link_target(member):
+    '''the path in the package a symlink or hardlink member points to'''
+    if member.islnk():
+        return member.linkname
+    return posixpath.normpath(posixpath.join(posixpath.dirname(member.name), member.linkname))
+
+
+def _removed_paths(members, patterns):
+    '''The paths of the members matching patterns, and of the links that would point to removed paths,
+    e.g. lib/libfoo.so -> libfoo.a
+    '''
+    names = {member.name for member in members}
+    removed = {name for name in names if not name.startswith('info/') and _matches(name, patterns)}
+    links = {member.name: _link_target(member) for member in members if member.issym() or member.islnk()}
+
+    def dangling(target):
+        if target in removed:
+            return True
+        if target in names:
+            return False
+        # a link to a directory, dangling once everything under it has gone
+        under = [name for name in names if name.startswith(target + '/')]
+        return bool(under) and all(name in removed for name in under)
+
+    # links can point to links
+    changed = bool(removed)
+    while changed:
+        changed = False
+        for name, target in links.items():
+            if name not in removed and dangling(target):
+                removed.add(name)
+                changed = True
+    return removed
+
+
+def _time_extract(package_path, destination):
+    # a python tarfile extraction into a scratch directory, which approximates but is not conda's own extraction.
+    # Extract the members as they are, without the stricter defaults of newer pythons
+    kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    start = time.perf_counter()
+    if package_path.endswith('.conda'):
+        with zipfile.ZipFile(package_path) as zf:
+            for name in zf.namelist():
+                if name.endswith('.tar.zst'):
+                    with _open_zst_tar(zf, name) as tar:
+                        tar.extractall(destination, **kwargs)
+    else:
+        with tarfile.open(package_path) as tar:
+            tar.extractall(destination, **kwargs)
+    return time.perf_counter() - start
+
+
+def _open_zst_tar(zf, name):
+    '''A tarfile reading the zstd compressed tar name of a .conda archive as a stream'''
+    return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(zf.open(name)), mode='r|')
+
+
+def _slim_info_files(tar, removed):
+    '''The info files that list the package contents, without the removed paths'''
+    replacements = {}
+    names = set(tar.getnames())
+    if 'info/paths.json' in names:
+        paths = json.load(tar.extractfile('info/paths.json'))
+        paths['paths'] = [p for p in paths['paths'] if p['_path'] not in removed]
+        replacements['info/paths.json'] = json.dumps(paths, indent=2, sort_keys=True).encode()
+    if 'info/files' in names:
+        lines = tar.extractfile('info/files').read().decode().splitlines()
+        replacements['info/files'] = ''.join(f'{line}\n' for line in lines if line not in removed).encode()
+    if 'info/has_prefix' in names:
+        # each line is either a path or: placeholder mode path
+        lines = tar.extractfile('info/has_prefix').read().decode().splitlines()
+        kept = [line for line in lines if line.rsplit(' ', 1)[-1].strip('"') not in removed and line.strip('"') not in removed]
+        replacements['info/has_prefix'] = ''.join(f'{line}\n' for line in kept).encode()
+    return replacements
+
+
+def _copy_members(tar, slim_tar, removed, replacements):
+    '''Copy the members of tar to slim_tar, leaving out the removed ones and replacing the content of the others'''
+    for member in tar:
+        if member.name in removed:
+            continue
+        if member.name in replacements:
+            data = replacements[member.name]
+            member.size = len(data)
+            slim_tar.addfile(member, io.BytesIO(data))
+        elif member.isfile():
+            slim_tar.addfile(member, tar.extractfile(member))
+        else:
+            slim_tar.addfile(member)
+
+
+def _slim_tar_bz2(package_path, slim_package_path, patterns):
+    with tarfile.open(package_path) as tar:
+        removed = _removed_paths(tar.getmembers(), patterns)
+        if not removed:
+            return removed
+        replacements = _slim_info_files(tar, removed)
+        with tarfile.open(slim_package_path, 'w:bz2') as slim_tar:
+            _copy_members(tar, slim_tar, removed, replacements)
+    return removed
+
+
+def _slim_conda(package_path, slim_package_path, patterns):
+    '''A .conda archive is an uncompressed zip of metadata.json, info-<stem>.tar.zst and pkg-<stem>.tar.zst'''
+    stem = os.path.basename(package_path)[:-len('.conda')]
+    info_name = f'info-{stem}.tar.zst'
+    pkg_name = f'pkg-{stem}.tar.zst'
+    with zipfile.ZipFile(package_path) as zf:
+        if pkg_name not in zf.namelist():
+            return set()
+        with _open_zst_tar(zf, pkg_name) as tar:
+            removed = _removed_paths(list(tar), patterns)
+        if not removed:
+            return removed
+
+        # the info tar is small, read it whole so that its files can be looked up by name
+        info = io.BytesIO()
+        with zf.open(info_name) as f:
+            zstandard.ZstdDecompressor().copy_stream(f, info)
+        info.seek(0)
+        with tarfile.open(fileobj=info) as info_tar:
+            replacements = _slim_info_files(info_tar, removed)
+
+        compressor = zstandard.ZstdCompressor(level=CONDA_COMPRESSION_LEVEL)
+        with zipfile.ZipFile(slim_package_path, 'w', zipfile.ZIP_STORED) as slim_zf:
+            for entry in zf.infolist():
+                slim_entry = zipfile.ZipInfo(entry.filename, entry.date_time)
+                if entry.filename not in (info_name, pkg_name):
+                    slim_zf.writestr(slim_entry, zf.read(entry))
+                    continue
+                if entry.filename == info_name:
+                    info.seek(0)
+                    source = tarfile.open(fileobj=info)
+                else:
+                    source = _open_zst_tar(zf, pkg_name)
+                with source as tar, \
+                        slim_zf.open(slim_entry, 'w', force_zip64=True) as dest, \
+                        compressor.stream_writer(dest) as writer, \
+                        tarfile.open(fileobj=writer, mode='w|') as slim_tar:
+                    _copy_members(tar, slim_tar, removed, replacements)
+    return removed
+
+
+def slim_package(package_path, patterns):
+    '''Repack a .tar.bz2 or .conda package in place, without the files matching patterns and the links to them.
+    Returns the bytes saved, the number of files removed and the seconds tarfile takes to extract the archive before and after
+    '''
+    if not can_slim(package_path):
+        raise ValueError(f'Cannot slim {package_path}, .conda packages need zstandard')
+    original_size = os.path.getsize(package_path)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(package_path)) as tmpdirname:
+        extract_before = _time_extract(package_path, os.path.join(tmpdirname, 'before'))
+        shutil.rmtree(os.path.join(tmpdirname, 'before'))
+
+        slim_package_path = os.path.join(tmpdirname, os.path.basename(package_path))
+        if package_path.endswith('.conda'):
+            removed = _slim_conda(package_path, slim_package_path, patterns)
+        else:
+            removed = _slim_tar_bz2(package_path, slim_package_path, patterns)
+        if not removed:
+            return 0, 0, extract_before, extract_before
+
+        extract_after = _time_extract(slim_package_path, os.path.join(tmpdirname, 'after'))
+        os.replace(slim_package_path, package_path)
+    return original_size - os.path.getsize(package_path), len(removed), extract_before, extract_after
@@ -0,0 +1,221 @@
+"""Sample the CPU, memory, disk and network use of the processes spawned while building the offline installer.
+This tells us whether a slow build stage is bound by the conda solver (CPU), the downloads (network)
+or the package extraction (disk). Sampling relies on /proc, so on Windows and macOS the processes are
+simply run without being sampled.
+"""
+import csv
+import json
+import os
+import subprocess
+import time
+
+
+class ResourceMonitor:
+    def __init__(self, interval=1.0):
+        '''
+        Every interval seconds, sum the resource usage of the process tree started by call().
+        An interval of None disables sampling.
+        '''
+        self.interval = interval
+        self.samples = []
+        self.stages = []
+        self.durations = {}
+        self.peak_rss = {}
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    @property
+    def enabled(self):
+        return self.interval is not None and os.path.exists('/proc/self/stat')
+
+    def _stage_name(self, stage):
+        '''stages can run more than once (e.g. conda install), keep their samples apart'''
+        name = stage
+        count = 1
+        while name in self.stages:
+            count += 1
+            name = f'{stage} ({count})'
+        self.stages.append(name)
+        return name
+
+    def call(self, args, stage, **kwargs):
+        '''Run args like subprocess.call, sampling the process tree under the given stage name'''
+        with subprocess.Popen(args, **kwargs) as process:
+            try:
+                if not self.enabled:
+                    return process.wait()
+                return self._sample_until_exit(process, self._stage_name(stage))
+            except BaseException:  # including KeyboardInterrupt, like subprocess.call
+                process.kill()
+                process.wait()
+                raise
+
+    def check_call(self, args, stage, **kwargs):
+        '''Run args like subprocess.check_call, sampling the process tree under the given stage name'''
+        returncode = self.call(args, stage, **kwargs)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def _sample_until_exit(self, process, stage):
+        start = time.monotonic()
+        net_start = self._network_bytes()
+        totals = {'ticks': 0, 'read_bytes': 0, 'write_bytes': 0}
+        last_sample = start
+        exited = False
+        while not exited:
+            exited = self._wait_for_exit(process.pid, self.interval)
+            # once the process has exited it is left as a zombie until reaped below,
+            # so this last sample still sees its CPU time and I/O, and those of its reaped children
+            now = time.monotonic()
+            self.samples.append(self._sample(process.pid, stage, now - start, now - last_sample, totals, net_start))
+            last_sample = now
+
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.durations[stage] = time.monotonic() - start
+        # ru_maxrss (in kB) covers the process and its reaped children, even if they were too short lived to be sampled
+        self.peak_rss[stage] = max([rusage.ru_maxrss * 1024] + [s['rss_bytes'] for s in self.samples if s['stage'] == stage])
+        return process.returncode
+
+    def _wait_for_exit(self, pid, timeout):
+        '''Wait up to timeout seconds for pid to exit, without reaping it'''
+        deadline = time.monotonic() + timeout
+        while True:
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | os.WNOHANG) is not None:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, 0.05))
+
+    def _sample(self, root_pid, stage, elapsed, interval, totals, net_start):
+        '''Sum the usage of the process tree. The kernel adds the CPU time and I/O of reaped children to their parent,
+        so the tree totals only grow, unless a process is orphaned
+        '''
+        ticks = 0
+        read_bytes = 0
+        write_bytes = 0
+        rss = 0
+        for pid in self._process_tree(root_pid):
+            stat = self._read_stat(pid)
+            if stat is None:
+                continue
+            process_ticks, rss_pages = stat
+            ticks += process_ticks
+            rss += rss_pages * self.page_size
+            io = self._read_io(pid)
+            if io is not None:
+                read_bytes += io[0]
+                write_bytes += io[1]
+        cpu_delta = max(ticks - totals['ticks'], 0)
+        totals['ticks'] = max(ticks, totals['ticks'])
+        totals['read_bytes'] = max(read_bytes, totals['read_bytes'])
+        totals['write_bytes'] = max(write_bytes, totals['write_bytes'])
+        return {
+            'stage': stage,
+            'elapsed': round(elapsed, 3),
+            'cpu_percent': round(100.0 * cpu_delta / self.clock_ticks / interval, 1) if interval > 0 else 0.0,
+            'rss_bytes': rss,
+            'read_bytes': totals['read_bytes'],
+            'write_bytes': totals['write_bytes'],
+            'net_bytes': self._network_bytes() - net_start,
+        }
+
+    def _process_tree(self, root_pid):
+        '''the root pid and all its descendants that are still alive'''
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        tree = [root_pid]
+        for pid in tree:
+            tree.extend(children.get(pid, []))
+        return tree
+
+    def _read_stat(self, pid):
+        '''(utime + stime + cutime + cstime in clock ticks, resident set size in pages) of a process'''
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        # fields start at the process state, the third field of /proc/<pid>/stat
+        return sum(int(field) for field in fields[11:15]), int(fields[21])
+
+    def _read_io(self, pid):
+        '''(bytes read from, bytes written to) the storage layer by a process'''
+        try:
+            with open(f'/proc/{pid}/io') as f:
+                counters = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            return None
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+
+    def _network_bytes(self):
+        '''bytes received and sent on all non-loopback interfaces.
+        Linux does not account network traffic per process, so this is system wide
+        '''
+        total = 0
+        try:
+            with open('/proc/net/dev') as f:
+                for line in f.readlines()[2:]:
+                    interface, counters = line.split(':', 1)
+                    if interface.strip() == 'lo':
+                        continue
+                    counters = counters.split()
+                    total += int(counters[0]) + int(counters[8])
+        except OSError:
+            pass
+        return total
+
+    def summary(self):
+        '''peak RSS, average CPU and I/O totals for each stage'''
+        stages = {}
+        for stage in self.stages:
+            samples = [s for s in self.samples if s['stage'] == stage]
+            last = samples[-1] if samples else {}
+            stages[stage] = {
+                'duration': round(self.durations.get(stage, 0.0), 3),
+                'samples': len(samples),
+                'peak_rss_bytes': self.peak_rss.get(stage, 0),
+                'average_cpu_percent': self._average_cpu_percent(samples),
+                'read_bytes': last.get('read_bytes', 0),
+                'write_bytes': last.get('write_bytes', 0),
+                'net_bytes': last.get('net_bytes', 0),
+            }
+        return stages
+
+    def _average_cpu_percent(self, samples):
+        '''CPU percentage over the whole stage, weighting each sample by the time it covers'''
+        covered = 0.0
+        busy = 0.0
+        previous = 0.0
+        for s in samples:
+            covered += s['elapsed'] - previous
+            busy += s['cpu_percent'] * (s['elapsed'] - previous)
+            previous = s['elapsed']
+        return round(busy / covered, 1) if covered > 0 else 0.0
+
+    def write(self, path_prefix):
+        '''Write the samples to <path_prefix>.csv and the summary to <path_prefix>-summary.json'''
+        if not self.stages:
+            return
+        with open(path_prefix + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['stage', 'elapsed', 'cpu_percent', 'rss_bytes', 'read_bytes', 'write_bytes', 'net_bytes'])
+            writer.writeheader()
+            writer.writerows(self.samples)
+        summary = self.summary()
+        with open(path_prefix + '-summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        print(f'Resource usage per stage (samples in {path_prefix}.csv)')
+        for stage, s in summary.items():
+            print(f"  - {stage}: {s['duration']:.0f}s, {s['average_cpu_percent']}% CPU, "
+                  f"peak RSS {s['peak_rss_bytes'] / 2**20:.0f}MB, read {s['read_bytes'] / 2**20:.0f}MB, "
+                  f"written {s['write_bytes'] / 2**20:.0f}MB, network {s['net_bytes'] / 2**20:.0f}MB")
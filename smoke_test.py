@@ -1,7 +1,9 @@
 import sys
+import time
 prefix = sys.argv[1]
 
 import_ok = True
+start = time.perf_counter()
 
 print('Testing all imports')
 try:
@@ -84,6 +86,8 @@ if prefix == 'full':
         print('Cannot import from tensorflow')
         import_ok = False
 
+print(f'Import time: {time.perf_counter() - start:.2f}s')
+
 if not import_ok:
     import sys
     sys.exit(1)